@@ -1,10 +1,55 @@
 from lib import Block
 from flask import Flask
 from flask import request
-from flask import render_template, redirect
-import datetime
+from flask import render_template, redirect, Response
 from hashlib import sha256
-import json
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import operator
+import os
+import secrets
+import struct
+import threading
+import time
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import numba
+    import numpy as np
+except ImportError:
+    numba = None
+
+try:
+    import numpy as np
+    import pycuda.driver as cuda
+    from pycuda.compiler import SourceModule
+except ImportError:
+    cuda = None
+
+# Binary block header: index, time stamp, previous hash, digest of the
+# transactions and nonce, laid out like Bitcoin's fixed-size header
+HEADER_FORMAT = struct.Struct('<QQ32s32sQ')
+NONCE_FORMAT = struct.Struct('<Q')
+
+
+def _previous_hash_bytes(previous_hash):
+    """Returns the 32 raw bytes of a previous hash. The genesis block's
+    "0" maps to all zero bytes, anything other than 64 hex characters
+    raises ValueError.
+    """
+    if previous_hash == "0":
+        return bytes(32)
+    if len(previous_hash) != 64:
+        raise ValueError("Invalid previous hash")
+    previous_hash_bytes = bytes.fromhex(previous_hash)
+    if len(previous_hash_bytes) != 32:
+        raise ValueError("Invalid previous hash")
+    return previous_hash_bytes
 
 
 class Block:
@@ -16,22 +61,67 @@ class Block:
         :param index: Unique ID for block.
         :param transactions: List of transactions.
         :param previous_hash: Unique hash of previous block.
-        :param time_stamp: Time of creation of block.
+        :param time_stamp: Time of creation of block, in nanoseconds since the epoch.
         """
         self.index = index
-        self.time_stamp = datetime.datetime.now()
-        self.transactions = transactions
+        self.time_stamp = time_stamp
+        # a copy, so later changes to the caller's list cannot drift
+        # from the header hashed below
+        self.transactions = list(transactions)
         self.previous_hash = previous_hash
         self.nonce = 0
-        self.hash = self.generate_hash()
+        # the binary header up to the nonce is packed once here, hashing
+        # only ever appends the packed nonce to it
+        previous_hash_bytes = _previous_hash_bytes(previous_hash)
+        merkle_root_bytes = sha256(
+            orjson.dumps(self.transactions, option=orjson.OPT_SORT_KEYS)).digest()
+        self._header_prefix = HEADER_FORMAT.pack(index, time_stamp, previous_hash_bytes,
+                                                 merkle_root_bytes, 0)[:-NONCE_FORMAT.size]
+        self.hash = self.compute_hash()
+
+    @classmethod
+    def from_dict(cls, block_data):
+        """Rebuilds a block from the fields produced by `to_dict`."""
+        block = cls(block_data["index"],
+                    block_data["transactions"],
+                    block_data["time_stamp"],
+                    block_data["previous_hash"])
+        block.nonce = block_data["nonce"]
+        # raises struct.error for a nonce that does not fit the header
+        NONCE_FORMAT.pack(block.nonce)
+        block.hash = block_data["hash"]
+        return block
+
+    def to_dict(self):
+        """Returns the block fields that are shared with other nodes."""
+        return {"index": self.index,
+                "transactions": self.transactions,
+                "time_stamp": self.time_stamp,
+                "previous_hash": self.previous_hash,
+                "nonce": self.nonce,
+                "hash": self.hash}
+
+    def header_bytes(self, nonce):
+        """Returns the fixed-size binary block header for the given nonce."""
+        return self._header_prefix + NONCE_FORMAT.pack(nonce)
+
+    def header_prefix(self):
+        """Returns the encoded block header without the nonce, which
+        stays the same for every attempt during proof of work.
+        """
+        return self._header_prefix
+
+    def compute_digest(self):
+        """Returns the raw sha256 digest of the block header."""
+        block_hash = sha256(self._header_prefix)
+        block_hash.update(NONCE_FORMAT.pack(self.nonce))
+        return block_hash.digest()
 
     def compute_hash(self):
-        """Returns the hash of a block instance
-        by converting it to JSON format.
+        """Returns the hash of a block instance as the hex sha256
+        digest of its binary header.
         """
-        block_header = str(self.time_stamp) + str(self.transactions) + str(self.previous_hash) + str(self.nonce)
-        block_hash = sha256(block_header.encode())
-        return str(block_hash.hexdigest())
+        return self.compute_digest().hex()
 
 
 # Testing
@@ -43,30 +133,587 @@ def test_contents(block):
     print("previous hash:", self.previous_hash)
 
 
+# Seconds /add_block waits for verification before answering 202
+VERIFY_TIMEOUT = 0.05
+
+# Start method for worker processes. Numba's parallel kernels leave
+# threads running, and a process forked under them can hang at exit, so
+# workers start from a fresh interpreter instead of a fork.
+_mp_context = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Process pool for hash verification, created on first use
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Returns the shared verification process pool."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ProcessPoolExecutor(mp_context=_mp_context)
+    return _executor
+
+
+# What a hash must look like for a difficulty: its hex prefix, and a
+# function telling whether a raw digest meets the difficulty criteria
+_DifficultyTarget = collections.namedtuple('_DifficultyTarget', ['prefix_hex', 'meets'])
+
+
+@functools.lru_cache()
+def _make_difficulty_check(difficulty):
+    """Builds the _DifficultyTarget for the given difficulty once."""
+    full_bytes, half_byte = divmod(difficulty, 2)
+    prefix_bytes = bytes(full_bytes)
+
+    # specialise the common shapes down to a single comparison
+    if half_byte:
+        # the half byte after the zero bytes must be zero too
+        mask = 0xF0
+
+        def check(digest):
+            return digest.startswith(prefix_bytes) and not digest[full_bytes] & mask
+    elif full_bytes == 1:
+        def check(digest):
+            return digest[0] == 0
+    else:
+        def check(digest):
+            return digest.startswith(prefix_bytes)
+
+    return _DifficultyTarget('0' * difficulty, check)
+
+
+def _verify_one(job):
+    """Check that a header hashes to the expected hash and that the
+    hash meets the difficulty criteria.
+    :param job: Tuple of (header bytes, expected hash, difficulty).
+    """
+    header, expected_hash, difficulty = job
+    digest = sha256(header).digest()
+    return _make_difficulty_check(difficulty).meets(digest) and expected_hash == digest.hex()
+
+
+def _is_linked(hashes, prev_hashes):
+    """Check that parallel lists of block hashes and previous hashes
+    form an unbroken chain starting from the genesis block.
+    """
+    return (bool(prev_hashes) and prev_hashes[0] == "0" and
+            all(map(operator.eq, prev_hashes[1:], hashes)))
+
+
+def _pow_serial(prefix, difficulty, start=0, step=1, stop=None):
+    """Search the nonces start, start + step, ... in this process and
+    return the first (nonce, hash) pair found, or None once `stop` is
+    set. Used directly for easy targets, where starting worker processes
+    costs more than the search itself.
+    :param stop: Event shared with other workers, polled every few
+        thousand attempts.
+    """
+    meets_difficulty = _make_difficulty_check(difficulty).meets
+    # the prefix is absorbed once, each attempt only hashes the nonce
+    base_ctx = sha256(prefix)
+    # the nonce is packed into one reusable buffer for every attempt
+    nonce_buffer = bytearray(NONCE_FORMAT.size)
+    # bind loop invariants locally to skip global and attribute lookups
+    copy_ctx = base_ctx.copy
+    pack_nonce_into = NONCE_FORMAT.pack_into
+    nonce = start
+    while stop is None or not stop.is_set():
+        for _ in range(4096):
+            block_hash = copy_ctx()
+            pack_nonce_into(nonce_buffer, 0, nonce)
+            block_hash.update(nonce_buffer)
+            digest = block_hash.digest()
+            if meets_difficulty(digest):
+                return nonce, digest.hex()
+            nonce += step
+    return None
+
+
+def _pow_worker(prefix, difficulty, start, step, found, results):
+    """Try every `step`-th nonce beginning at `start` until one meets the
+    difficulty criteria or another worker reports a solution.
+    """
+    result = _pow_serial(prefix, difficulty, start, step, stop=found)
+    if result is not None:
+        results.put(result)
+        found.set()
+
+
+def _pow_parallel(prefix, difficulty, start=0, step=1):
+    """Split the nonces start, start + step, start + 2 * step, ... across
+    one worker process per CPU core and return the first (nonce, hash)
+    pair that any of them finds.
+    :param prefix: Binary block header without the nonce.
+    :param difficulty: Number of leading zeros required.
+    :param start: First nonce of the slice to search.
+    :param step: Distance between consecutive nonces of the slice.
+    """
+    workers = os.cpu_count() or 1
+    found = _mp_context.Event()
+    results = _mp_context.Queue()
+    # worker tid takes every workers-th nonce of the slice, so no two
+    # workers ever hash the same nonce
+    processes = [_mp_context.Process(target=_pow_worker,
+                                     args=(prefix, difficulty,
+                                           start + tid * step, workers * step,
+                                           found, results),
+                                     daemon=True)
+                 for tid in range(workers)]
+    for process in processes:
+        process.start()
+
+    nonce, proof = results.get()
+
+    found.set()
+    for process in processes:
+        process.terminate()
+        process.join()
+    return nonce, proof
+
+
+# SHA-256 round constants and initial hash value
+_SHA256_K = (
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2)
+_SHA256_IV = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+              0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+
+# Nonces each parallel chunk of the compiled miner tries per call
+_NUMBA_CHUNK_SIZE = 1 << 16
+
+# The compiled miner below works on int64 values holding 32-bit words
+# and masks after every addition or left shift.
+
+
+def _rotr(x, n):
+    return ((x >> n) | (x << (32 - n))) & 0xFFFFFFFF
+
+
+def _bswap32(x):
+    return (((x & 0xFF) << 24) | (((x >> 8) & 0xFF) << 16) |
+            (((x >> 16) & 0xFF) << 8) | ((x >> 24) & 0xFF))
+
+
+def _sha256_compress(state, w):
+    """Runs the 64 SHA-256 rounds over a message schedule whose first
+    16 words hold one block, adding the result into `state`.
+    """
+    for i in range(16, 64):
+        s0 = _rotr(w[i - 15], 7) ^ _rotr(w[i - 15], 18) ^ (w[i - 15] >> 3)
+        s1 = _rotr(w[i - 2], 17) ^ _rotr(w[i - 2], 19) ^ (w[i - 2] >> 10)
+        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) & 0xFFFFFFFF
+
+    a, b, c, d = state[0], state[1], state[2], state[3]
+    e, f, g, h = state[4], state[5], state[6], state[7]
+    for i in range(64):
+        s1 = _rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25)
+        ch = (e & f) ^ ((e ^ 0xFFFFFFFF) & g)
+        t1 = (h + s1 + ch + _SHA256_K[i] + w[i]) & 0xFFFFFFFF
+        s0 = _rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        t2 = (s0 + maj) & 0xFFFFFFFF
+        h, g, f, e = g, f, e, (d + t1) & 0xFFFFFFFF
+        d, c, b, a = c, b, a, (t1 + t2) & 0xFFFFFFFF
+
+    state[0] = (state[0] + a) & 0xFFFFFFFF
+    state[1] = (state[1] + b) & 0xFFFFFFFF
+    state[2] = (state[2] + c) & 0xFFFFFFFF
+    state[3] = (state[3] + d) & 0xFFFFFFFF
+    state[4] = (state[4] + e) & 0xFFFFFFFF
+    state[5] = (state[5] + f) & 0xFFFFFFFF
+    state[6] = (state[6] + g) & 0xFFFFFFFF
+    state[7] = (state[7] + h) & 0xFFFFFFFF
+
+
+def _has_leading_zeros(state, difficulty):
+    """Check that the top 4 * difficulty bits of a digest are zero."""
+    bits = 4 * difficulty
+    i = 0
+    while bits >= 32:
+        if state[i] != 0:
+            return False
+        bits -= 32
+        i += 1
+    return bits == 0 or state[i] >> (32 - bits) == 0
+
+
+def _mine_chunks(midstate, tail, difficulty, start, step, chunk_size, found):
+    """
+    Tries chunk_size consecutive nonces of the slice start, start + step,
+    ... in each of len(found) chunks, in parallel when compiled.
+    found[c] is set to the first nonce of chunk c that meets the
+    difficulty criteria, or -1 if none does.
+    :param midstate: SHA-256 state after the first 64 header bytes.
+    :param tail: Padded final block with the nonce words left empty.
+    """
+    for c in _prange(len(found)):
+        w = np.empty(64, np.int64)
+        state = np.empty(8, np.int64)
+        found[c] = -1
+        for j in range(chunk_size):
+            nonce = start + (c * chunk_size + j) * step
+            for k in range(16):
+                w[k] = tail[k]
+            # the nonce is packed little-endian, SHA-256 reads big-endian words
+            w[4] = _bswap32(nonce & 0xFFFFFFFF)
+            w[5] = _bswap32((nonce >> 32) & 0xFFFFFFFF)
+            for k in range(8):
+                state[k] = midstate[k]
+            _sha256_compress(state, w)
+            if _has_leading_zeros(state, difficulty):
+                found[c] = nonce
+                break
+
+
+if numba is not None:
+    _prange = numba.prange
+    _rotr = numba.njit(cache=True)(_rotr)
+    _bswap32 = numba.njit(cache=True)(_bswap32)
+    _sha256_compress = numba.njit(cache=True)(_sha256_compress)
+    _has_leading_zeros = numba.njit(cache=True)(_has_leading_zeros)
+    _mine_chunks = numba.njit(cache=True, parallel=True)(_mine_chunks)
+else:
+    _prange = range
+
+
+# Numba's default threading layer aborts the process when two threads
+# launch parallel kernels at once, so calls into the miner are serialized
+_numba_lock = threading.Lock()
+
+
+def _sha256_tail(prefix, dtype):
+    """Returns the padded final SHA-256 block of a header as 16 words,
+    with the nonce words left empty.
+    :param prefix: Binary block header without the nonce.
+    :param dtype: numpy type of the words.
+    """
+    # the final block holds the rest of the prefix, the nonce and padding
+    tail = np.zeros(16, dtype)
+    tail[:4] = struct.unpack('>4I', prefix[64:])
+    tail[6] = 0x80000000
+    tail[15] = (len(prefix) + NONCE_FORMAT.size) * 8
+    return tail
+
+
+def _numba_message(prefix):
+    """Returns the SHA-256 midstate after the first 64 header bytes and
+    the padded final block, with the nonce words left empty.
+    :param prefix: Binary block header without the nonce.
+    """
+    # the first 64 header bytes never change, compress them once
+    midstate = np.array(_SHA256_IV, np.int64)
+    w = np.zeros(64, np.int64)
+    w[:16] = struct.unpack('>16I', prefix[:64])
+    _sha256_compress(midstate, w)
+    return midstate, _sha256_tail(prefix, np.int64)
+
+
+@functools.lru_cache()
+def _numba_miner_works():
+    """Check the compiled SHA-256 against hashlib once before the
+    compiled miner is trusted with a block.
+    """
+    prefix = bytes(range(HEADER_FORMAT.size - NONCE_FORMAT.size))
+    with _numba_lock:
+        midstate, tail = _numba_message(prefix)
+        for nonce in (0, 1, 0xdeadbeef, (1 << 63) - 1):
+            w = np.zeros(64, np.int64)
+            w[:16] = tail
+            w[4] = _bswap32(nonce & 0xFFFFFFFF)
+            w[5] = _bswap32((nonce >> 32) & 0xFFFFFFFF)
+            state = midstate.copy()
+            _sha256_compress(state, w)
+            digest = b"".join(int(word).to_bytes(4, 'big') for word in state)
+            if digest != sha256(prefix + NONCE_FORMAT.pack(nonce)).digest():
+                return False
+
+        found = np.empty(2, np.int64)
+        _mine_chunks(midstate, tail, 1, 0, 1, 256, found)
+    return all(nonce >= 0 and
+               sha256(prefix + NONCE_FORMAT.pack(int(nonce))).digest()[0] < 0x10
+               for nonce in found)
+
+
+def _pow_numba(prefix, difficulty, start=0, step=1):
+    """Search the nonces start, start + step, ... with the Numba
+    compiled miner and return the first (nonce, hash) pair found.
+    :param prefix: Binary block header without the nonce.
+    :param difficulty: Number of leading zeros required.
+    """
+    with _numba_lock:
+        midstate, tail = _numba_message(prefix)
+        found = np.empty(4 * numba.get_num_threads(), np.int64)
+        while True:
+            _mine_chunks(midstate, tail, difficulty, start, step, _NUMBA_CHUNK_SIZE, found)
+            for nonce in found:
+                if nonce >= 0:
+                    nonce = int(nonce)
+                    return nonce, sha256(prefix + NONCE_FORMAT.pack(nonce)).hexdigest()
+            start += len(found) * _NUMBA_CHUNK_SIZE * step
+
+
+# CUDA miner: every thread hashes the header for its own nonces, starting
+# from a midstate that covers the first 64 header bytes
+_CUDA_MINER_SOURCE = """
+__constant__ unsigned int K[64] = {%s};
+
+__device__ __forceinline__ unsigned int rotr(unsigned int x, unsigned int n)
+{
+    return (x >> n) | (x << (32 - n));
+}
+
+__device__ void sha256_compress(unsigned int state[8], unsigned int w[64])
+{
+    #pragma unroll
+    for (int i = 16; i < 64; i++) {
+        unsigned int s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >> 3);
+        unsigned int s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >> 10);
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+
+    unsigned int a = state[0], b = state[1], c = state[2], d = state[3];
+    unsigned int e = state[4], f = state[5], g = state[6], h = state[7];
+    #pragma unroll
+    for (int i = 0; i < 64; i++) {
+        unsigned int t1 = h + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) +
+                          ((e & f) ^ (~e & g)) + K[i] + w[i];
+        unsigned int t2 = (rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) +
+                          ((a & b) ^ (a & c) ^ (b & c));
+        h = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+
+    state[0] += a; state[1] += b; state[2] += c; state[3] += d;
+    state[4] += e; state[5] += f; state[6] += g; state[7] += h;
+}
+
+__global__ void sha256_midstate(const unsigned int *words, unsigned int *midstate)
+{
+    unsigned int w[64];
+    unsigned int state[8] = {%s};
+    for (int i = 0; i < 16; i++)
+        w[i] = words[i];
+    sha256_compress(state, w);
+    for (int i = 0; i < 8; i++)
+        midstate[i] = state[i];
+}
+
+__global__ void mine(const unsigned int *midstate, const unsigned int *tail,
+                     unsigned int zero_bits, unsigned long long start,
+                     unsigned long long step, unsigned long long base,
+                     unsigned int per_thread, unsigned long long *found)
+{
+    unsigned long long threads = (unsigned long long)gridDim.x * blockDim.x;
+    unsigned long long tid = (unsigned long long)blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int w[64];
+    unsigned int state[8];
+
+    for (unsigned int k = 0; k < per_thread; k++) {
+        /* stop once any thread has found a solution */
+        if (*(volatile unsigned long long *)found != ~0ULL)
+            return;
+
+        unsigned long long nonce = start + (base + k * threads + tid) * step;
+        for (int i = 0; i < 16; i++)
+            w[i] = tail[i];
+        /* the nonce is packed little-endian, SHA-256 reads big-endian words */
+        w[4] = __byte_perm((unsigned int)nonce, 0, 0x0123);
+        w[5] = __byte_perm((unsigned int)(nonce >> 32), 0, 0x0123);
+        for (int i = 0; i < 8; i++)
+            state[i] = midstate[i];
+        sha256_compress(state, w);
+
+        unsigned int bits = zero_bits;
+        int ok = 1;
+        for (int i = 0; i < 8 && bits > 0; i++) {
+            unsigned int n = bits < 32 ? bits : 32;
+            if (state[i] >> (32 - n) != 0) {
+                ok = 0;
+                break;
+            }
+            bits -= n;
+        }
+        if (ok) {
+            atomicMin(found, nonce);
+            return;
+        }
+    }
+}
+""" % (", ".join("0x%08xU" % k for k in _SHA256_K),
+       ", ".join("0x%08xU" % v for v in _SHA256_IV))
+
+_GPU_THREADS_PER_BLOCK = 256
+# Hashes per kernel launch, the host checks for a solution in between
+_GPU_HASHES_PER_LAUNCH = 1 << 30
+_GPU_NOT_FOUND = (1 << 64) - 1
+
+# (context, midstate kernel, mining kernel, blocks per launch) once the
+# CUDA miner is compiled, False when no GPU is usable
+_gpu = None
+_gpu_lock = threading.Lock()
+
+
+def _get_gpu():
+    """Compiles the CUDA miner on first use. Returns None when PyCUDA
+    is not installed or no GPU is usable.
+    """
+    global _gpu
+    if cuda is None:
+        return None
+    # concurrent /mine requests must not each create a context
+    with _gpu_lock:
+        if _gpu is None:
+            try:
+                cuda.init()
+                device = cuda.Device(0)
+                context = device.make_context()
+                try:
+                    module = SourceModule(_CUDA_MINER_SOURCE)
+                finally:
+                    context.pop()
+            except cuda.Error:
+                _gpu = False
+            else:
+                blocks = device.get_attribute(cuda.device_attribute.MULTIPROCESSOR_COUNT) * 32
+                _gpu = (context, module.get_function('sha256_midstate'),
+                        module.get_function('mine'), blocks)
+    return _gpu or None
+
+
+def _gpu_mine(prefix, difficulty, start=0, step=1):
+    """Search the nonces start, start + step, ... on the GPU and return
+    the first (nonce, hash) pair found.
+    :param prefix: Binary block header without the nonce.
+    :param difficulty: Number of leading zeros required.
+    """
+    context, midstate_kernel, mine_kernel, blocks = _get_gpu()
+    context.push()
+    try:
+        words = np.array(struct.unpack('>16I', prefix[:64]), np.uint32)
+        midstate = cuda.mem_alloc(32)
+        midstate_kernel(cuda.In(words), midstate, block=(1, 1, 1), grid=(1, 1))
+        tail = _sha256_tail(prefix, np.uint32)
+
+        threads = _GPU_THREADS_PER_BLOCK * blocks
+        per_thread = max(1, _GPU_HASHES_PER_LAUNCH // threads)
+        found = np.array([_GPU_NOT_FOUND], np.uint64)
+        base = 0
+        while True:
+            mine_kernel(midstate, cuda.In(tail), np.uint32(4 * difficulty),
+                        np.uint64(start), np.uint64(step), np.uint64(base),
+                        np.uint32(per_thread), cuda.InOut(found),
+                        block=(_GPU_THREADS_PER_BLOCK, 1, 1), grid=(blocks, 1))
+            if found[0] != _GPU_NOT_FOUND:
+                nonce = int(found[0])
+                # never trust the kernel with a block, check its nonce
+                digest = sha256(prefix + NONCE_FORMAT.pack(nonce)).digest()
+                if not _make_difficulty_check(difficulty).meets(digest):
+                    raise RuntimeError("GPU miner returned nonce {} that does not "
+                                       "meet the difficulty".format(nonce))
+                return nonce, digest.hex()
+            base += per_thread * threads
+    finally:
+        context.pop()
+
+
+@functools.lru_cache()
+def _gpu_miner_works():
+    """Check the CUDA miner against hashlib once before it is trusted
+    with a block.
+    """
+    prefix = bytes(range(HEADER_FORMAT.size - NONCE_FORMAT.size))
+    try:
+        _gpu_mine(prefix, 2)
+    except (RuntimeError, cuda.Error):
+        return False
+    return True
+
+
 class Blockchain:
     # set difficulty of Proof of Work algorithm
     difficulty = 2
-
-    def __init__(self):
+    # start each nonce search at a random offset instead of 0
+    rand_nonce = False
+    # search in worker processes from this difficulty on, easier targets
+    # are mined faster in process
+    parallel_min_difficulty = 5
+    # mine on the GPU from this difficulty on, when one is available
+    gpu_min_difficulty = 6
+
+    def __init__(self, genesis=None):
         self.chain = []
+        # serialized form of `chain` for /chain, extended on every append
+        self._serialized_chain = []
+        # bumped on every append so /chain can tag each state of the chain
+        self.version = 0
+        # guards appends, which can come from request threads as well as
+        # the verification pool's callback thread
+        self._lock = threading.RLock()
         self.unconfirmed_transactions = []
-        self.genesis_block()
-        self.previous_block = self.chain[len(self.chain) - 1].hash
+        self.genesis_block(genesis)
+        self.previous_block = self.chain[-1].hash
 
-    def genesis_block(self):
+    def genesis_block(self, genesis=None):
         """
         Creates genesis block and appends it to chain. The block has
         index 0, previous_hash as 0, and a valid given hash.
+        :param genesis: Genesis block to start from instead, such as
+            one received from another node.
+        """
+        if genesis is None:
+            # every chain in this process starts from the same genesis block
+            genesis = Block.from_dict(_GENESIS_BLOCK_DATA)
+        self._append(genesis)
+
+    @classmethod
+    def from_verified_blocks(cls, blocks, pending=()):
+        """
+        Builds a blockchain from blocks that have already passed
+        `check_chain_validity`, without verifying them again.
+        :param pending: Unconfirmed transactions to carry over, those
+            already in one of the blocks are dropped.
         """
-        transactions = {}
-        genesis_block = Block(0, [], datetime.datetime.now(), "0")
-        genesis_block.hash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
+        blockchain = cls(genesis=blocks[0])
+        for block in blocks[1:]:
+            blockchain._append(block)
+
+        confirmed = {orjson.dumps(transaction, option=orjson.OPT_SORT_KEYS)
+                     for block in blocks for transaction in block.transactions}
+        blockchain.unconfirmed_transactions = [
+            transaction for transaction in pending
+            if orjson.dumps(transaction, option=orjson.OPT_SORT_KEYS) not in confirmed]
+        return blockchain
+
+    def _append(self, block):
+        """Appends a block to the chain and its serialized form."""
+        with self._lock:
+            self.chain.append(block)
+            self._serialized_chain.append(block.to_dict())
+            self.version += 1
 
     @property
     def last_block(self):
         return self.chain[-1]
 
+    def chain_data(self):
+        """Returns the chain as a list of dicts ready to be serialized."""
+        return self._serialized_chain
+
+    @property
+    def etag(self):
+        """Tag identifying the current state of the chain. The last
+        hash keeps it unique when the whole chain is replaced.
+        """
+        return "{}-{}".format(self.version, self.last_block.hash)
+
     def add_block(self, block, proof):
         """
         A function that adds the block to the blockchain, after
@@ -76,83 +723,190 @@ class Blockchain:
         :param proof of block
         :return:
         """
-        previous_block_hash = self.last_block.hash
-
         # verify if block is valid
-        if previous_block_hash != block.previous_hash:
+        if self.last_block.hash != block.previous_hash:
             return False
         if not self.is_valid(block, proof):
             return False
 
-        proof = block.previous_hash
-        self.chain.append(block)
-        return True
+        return self.add_verified_block(block, proof)
+
+    def add_verified_block(self, block, proof):
+        """
+        Adds a block whose proof of work has already been verified,
+        as long as it still extends the current last block.
+        :param block
+        :param proof of block
+        :return:
+        """
+        with self._lock:
+            if self.last_block.hash != block.previous_hash:
+                return False
+
+            block.hash = proof
+            self._append(block)
+            return True
 
     def is_valid(self, block, block_hash):
         """Check if block_hash is a valid hash and
         meets the difficulty criteria.
         """
-        return (block_hash.startswith('0' * Blockchain.difficulty) and
-                block_hash == block.compute_hash())
+        digest = block.compute_digest()
+        meets_difficulty = _make_difficulty_check(Blockchain.difficulty).meets
+        return meets_difficulty(digest) and block_hash == digest.hex()
 
-    def proof_of_work(self, block):
+    def proof_of_work(self, block, worker_id=0, num_workers=1):
         """Function that attempts different values of nonce to get a
-        hash that meets the difficulty criteria."""
-        proof = block.compute_hash()
-        while proof[:difficulty] != '0' * Blockchain.difficulty:
-            block.nonce += 1
-            proof = block.compute_hash()
-        # reset nonce
-        block.nonce = 0
+        hash that meets the difficulty criteria.
+        :param block
+        :param worker_id: Index of this miner among num_workers miners.
+        :param num_workers: Number of miners sharing the nonce space,
+            miner i only tries nonces i, i + num_workers, ...
+        """
+        start = worker_id
+        if Blockchain.rand_nonce:
+            start += secrets.randbits(32) * num_workers
+        # mine easy targets in process, prefer the GPU for hard targets,
+        # then the compiled miner, and fall back to one process per core
+        if Blockchain.difficulty < Blockchain.parallel_min_difficulty:
+            pow_search = _pow_serial
+        elif Blockchain.difficulty >= Blockchain.gpu_min_difficulty and \
+                _get_gpu() and _gpu_miner_works():
+            pow_search = _gpu_mine
+        elif numba is not None and _numba_miner_works():
+            pow_search = _pow_numba
+        else:
+            pow_search = _pow_parallel
+        block.nonce, proof = pow_search(block.header_prefix(), Blockchain.difficulty,
+                                        start, num_workers)
         return proof
 
     def add_new_transaction(self, transaction):
-        self.unconfirmed_transactions.append(transaction)
+        with self._lock:
+            self.unconfirmed_transactions.append(transaction)
 
     def interface(self):
         """Serves as an interface to add pending transactions to blockchain
         by adding them to block and verifying Proof of Work algorithm.
         """
-
-        if not self.unconfirmed_transactions:
+        # take the pending transactions and reset them in one step, so
+        # transactions arriving while mining wait for the next block
+        with self._lock:
+            transactions = self.unconfirmed_transactions
+            self.unconfirmed_transactions = []
+        if not transactions:
             return False
 
         last_block = self.last_block
 
         new_block = Block(index=last_block.index + 1,
-                          transactions=self.unconfirmed_transactions,
-                          timestamp=datetime.datetime.now(),
+                          transactions=transactions,
+                          time_stamp=time.time_ns(),
                           previous_hash=last_block.hash)
 
-        proof = self.proof_of_work(new_block)
-        self.add_block(new_block, proof)
-
-        # reset unconfirmed transactions
-        self.unconfirmed_transactions = []
+        added = False
+        try:
+            proof = self.proof_of_work(new_block)
+            added = self.add_block(new_block, proof)
+        finally:
+            if not added:
+                # the block was not added, keep its transactions pending
+                with self._lock:
+                    self.unconfirmed_transactions[:0] = transactions
+        if not added:
+            return False
         return new_block.index
 
+    @classmethod
     def check_chain_validity(cls, chain):
         """
         A helper method to check if the entire blockchain is valid.
         """
-        result = True
-        previous_hash = "0"
-
-        # Iterate through every block
-        for block in chain:
-            block_hash = block.hash
-            # remove the hash field to recompute the hash again
-            # using `compute_hash` method.
-            delattr(block, "hash")
-
-            if not cls.is_valid(block, block.hash) or \
-                    previous_hash != block.previous_hash:
-                result = False
-                break
+        # cheap pass over the stored hashes: every block must point at
+        # the hash of the one before it and claim enough leading zeros.
+        hashes = [block.hash for block in chain]
+        prev_hashes = [block.previous_hash for block in chain]
+        target = _make_difficulty_check(cls.difficulty).prefix_hex
+        if not _is_linked(hashes, prev_hashes) or \
+                not all(block_hash.startswith(target) for block_hash in hashes[1:]):
+            return False
+
+        # the genesis block is not mined, so only the difficulty check is
+        # skipped for it: it must be empty and carry its own hash
+        genesis = chain[0]
+        if genesis.index != 0 or genesis.transactions or \
+                genesis.hash != genesis.compute_hash():
+            return False
+
+        # expensive pass: recompute the hashes of the mined blocks in the
+        # process pool
+        jobs = [(block.header_bytes(block.nonce), block.hash, cls.difficulty)
+                for block in chain[1:]]
+        return all(_get_executor().map(_verify_one, jobs, chunksize=64))
+
+
+# The genesis block is created and serialized once per process
+_GENESIS_BLOCK_DATA = Block(0, [], time.time_ns(), "0").to_dict()
 
-            block.hash, previous_hash = block_hash, block_hash
 
-        return result
+# Shared HTTP session so requests to peers reuse pooled connections
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=64, pool_maxsize=64))
+_session.mount('https://', HTTPAdapter(pool_connections=64, pool_maxsize=64))
+
+# Last ETag seen from each participant's /chain
+_peer_etags = {}
+
+# Threads that post new blocks to peers in the background
+_announce_pool = concurrent.futures.ThreadPoolExecutor(max_workers=32)
+
+
+def _fetch_valid_chain(node, min_length):
+    """
+    Fetches the chain of a participant, returning its blocks only if
+    the chain is longer than min_length and valid.
+    """
+    # skip participants whose chain has not changed since the last poll
+    headers = {}
+    if node in _peer_etags:
+        headers['If-None-Match'] = _peer_etags[node]
+    try:
+        response = _session.get('{}/chain'.format(node), headers=headers, timeout=3)
+    except requests.RequestException:
+        return None
+    if response.status_code == 304:
+        return None
+
+    chain = _parse_valid_chain(response, min_length)
+    # only remember the ETag of a chain that was accepted, so a rejected
+    # participant is fetched in full again next time
+    if chain is not None and 'ETag' in response.headers:
+        _peer_etags[node] = response.headers['ETag']
+    else:
+        _peer_etags.pop(node, None)
+    return chain
+
+
+def _parse_valid_chain(response, min_length):
+    """
+    Returns the blocks of a /chain response if the chain is longer than
+    min_length and valid, None otherwise.
+    """
+    if response.status_code != 200:
+        return None
+
+    # a malformed chain is treated like an unreachable participant
+    try:
+        chain_info = orjson.loads(response.content)
+        if chain_info['length'] <= min_length:
+            return None
+
+        chain = [Block.from_dict(block_data) for block_data in chain_info['chain']]
+        if not Blockchain.check_chain_validity(chain):
+            return None
+    except (AttributeError, KeyError, TypeError, ValueError, struct.error):
+        return None
+    return chain
 
 
 def consensus():
@@ -162,20 +916,22 @@ def consensus():
     """
     global blockchain
 
-    longest_chain = None
+    nodes = participants_snapshot()
+    if not nodes:
+        return False
+
     current_len = len(blockchain.chain)
 
-    for node in participants:
-        response = requests.get('{}/chain'.format(node))
-        length = response.json()['length']
-        chain = response.json()['chain']
-        if length > current_len and blockchain.check_chain_validity(chain):
-            # Longer valid chain found!
-            current_len = length
-            longest_chain = chain
-
-    if longest_chain:
-        blockchain = longest_chain
+    # fetch and validate every participant's chain at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(nodes))) as pool:
+        chains = [chain for chain in
+                  pool.map(lambda node: _fetch_valid_chain(node, current_len), nodes)
+                  if chain]
+
+    if chains:
+        # Longer valid chain found! Its blocks were verified while fetching.
+        blockchain = Blockchain.from_verified_blocks(
+            max(chains, key=len), pending=list(blockchain.unconfirmed_transactions))
         return True
 
     return False
@@ -199,21 +955,38 @@ def new_transaction():
         if not tx_data.get(field):
             return "Invalid transaction data", 404
 
-    tx_data["timestamp"] = datetime.datetime.now()
+    tx_data["timestamp"] = time.time_ns()
+
+    # blocks hash their transactions with orjson, which rejects values
+    # such as integers beyond 64 bits, so such a transaction could never
+    # be mined
+    try:
+        orjson.dumps(tx_data, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        return "Invalid transaction data", 400
 
     blockchain.add_new_transaction(tx_data)
 
     return "Success", 201
 
 
+def _json_response(data):
+    """Serializes data with orjson into a JSON response."""
+    return Response(orjson.dumps(data), mimetype='application/json')
+
+
 # Get copy of node's current blockchain
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_data = []
-    for block in blockchain.chain:
-        chain_data.append(block.__dict__)
-    return json.dumps({"length": len(chain_data),
-                       "chain": chain_data})
+    etag = blockchain.etag
+    if request.if_none_match.contains(etag):
+        return Response(status=304)
+
+    chain_data = blockchain.chain_data()
+    response = _json_response({"length": len(chain_data),
+                               "chain": chain_data})
+    response.set_etag(etag)
+    return response
 
 
 # Mine any unconfirmed transactions
@@ -227,11 +1000,21 @@ def mine_unconfirmed_transactions():
 
 @app.route('/pending_tx')
 def get_pending_tx():
-    return json.dumps(blockchain.unconfirmed_transactions)
+    return _json_response(blockchain.unconfirmed_transactions)
 
 
-# Contains the host addresses of other participating members of the network
-participants = set()
+# Contains the host addresses of other participating members of the network,
+# guarded by _participants_lock since request threads share it
+_participants = set()
+_participants_lock = threading.RLock()
+
+
+def participants_snapshot():
+    """Returns the current participants as a sorted tuple that can be
+    iterated without holding the lock.
+    """
+    with _participants_lock:
+        return tuple(sorted(_participants))
 
 
 # Endpoint to add new participants to the network
@@ -243,7 +1026,8 @@ def register_new_participants():
         return "Invalid data", 400
 
     # Add the node to the participants list
-    participants.add(node_address)
+    with _participants_lock:
+        _participants.add(node_address)
 
     # Return the blockchain to the newly registered node so that it can sync
     return get_chain()
@@ -265,15 +1049,16 @@ def register_with_existing_node():
 
     # Make a request to register with remote node and obtain information
     response = requests.post(node_address + "/register_node",
-                             data=json.dumps(data), headers=headers)
+                             data=orjson.dumps(data), headers=headers)
 
     if response.status_code == 200:
         global blockchain
-        global participants
         # update chain and the participants
-        chain_dump = response.json()['chain']
+        chain_info = orjson.loads(response.content)
+        chain_dump = chain_info['chain']
         blockchain = create_chain_from_dump(chain_dump)
-        participants.update(response.json()['participants'])
+        with _participants_lock:
+            _participants.update(chain_info['participants'])
         return "Registration successful", 200
     else:
         # If error is encountered, pass it on to the API response
@@ -281,19 +1066,14 @@ def register_with_existing_node():
 
 
 def create_chain_from_dump(chain_dump):
-    blockchain = Blockchain()
-    for idx, block_data in enumerate(chain_dump):
-        block = Block(block_data["index"],
-                      block_data["transactions"],
-                      block_data["timestamp"],
-                      block_data["previous_hash"])
+    # the first block is a genesis block, no verification needed
+    blockchain = Blockchain(genesis=Block.from_dict(chain_dump[0]))
+    for block_data in chain_dump[1:]:
+        block = Block.from_dict(block_data)
         proof = block_data['hash']
-        if idx > 0:
-            added = blockchain.add_block(block, proof)
-            if not added:
-                raise Exception("The chain dump is tampered!!")
-        else:  # the block is a genesis block, no verification needed
-            blockchain.chain.append(block)
+        added = blockchain.add_block(block, proof)
+        if not added:
+            raise Exception("The chain dump is tampered!!")
     return blockchain
 
 
@@ -303,15 +1083,24 @@ def create_chain_from_dump(chain_dump):
 @app.route('/add_block', methods=['POST'])
 def verify_and_add_block():
     block_data = request.get_json()
-    block = Block(block_data["index"],
-                  block_data["transactions"],
-                  block_data["timestamp"],
-                  block_data["previous_hash"])
-
-    proof = block_data['hash']
-    added = blockchain.add_block(block, proof)
-
-    if not added:
+    try:
+        block = Block.from_dict(block_data)
+    except (KeyError, TypeError, ValueError, struct.error):
+        return "Invalid block data", 400
+
+    proof = block.hash
+
+    # verify off the request thread, answering early if it takes too long
+    job = (block.header_bytes(block.nonce), proof, Blockchain.difficulty)
+    verification = _get_executor().submit(_verify_one, job)
+    try:
+        valid = verification.result(timeout=VERIFY_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        verification.add_done_callback(
+            lambda done: done.result() and blockchain.add_verified_block(block, proof))
+        return "Block verification pending", 202
+
+    if not valid or not blockchain.add_verified_block(block, proof):
         return "The block was discarded by the node", 400
 
     return "Block added to the chain", 201
@@ -321,11 +1110,15 @@ def announce_new_block(block):
     """
     Announce to the network once a block has been mined.
     Other blocks can simply verify the proof of work and add it to their
-    respective chains.
+    respective chains. The posts are sent in the background so the
+    caller does not wait on any participant.
     """
-    for participant in participants:
+    payload = orjson.dumps(block.to_dict(), option=orjson.OPT_SORT_KEYS)
+    headers = {'Content-Type': "application/json"}
+    for participant in participants_snapshot():
         url = "{}add_block".format(participant)
-        requests.post(url, data=json.dumps(block.__dict__, sort_keys=True))
+        _announce_pool.submit(_session.post, url, data=payload,
+                              headers=headers, timeout=2)
 
 
 @app.route('/mine', methods=['GET'])
@@ -343,4 +1136,5 @@ def mine_unconfirmed_transactions():
         return "Block #{} is mined.".format(blockchain.last_block.index)
 
 
-app.run(debug=True, port=8000)
\ No newline at end of file
+if __name__ == '__main__':
+    app.run(debug=True, port=8000)
\ No newline at end of file
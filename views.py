@@ -68,5 +68,5 @@ def submit_textarea():
     return redirect('/')
 
 
-def timestamp_to_string(epoch_time):
-    return datetime.datetime.fromtimestamp(epoch_time).strftime('%H:%M')
\ No newline at end of file
+def timestamp_to_string(epoch_time_ns):
+    return datetime.datetime.fromtimestamp(epoch_time_ns / 1e9).strftime('%H:%M')
\ No newline at end of file